@@ -1,8 +1,16 @@
 # app.py – ImageMaster Pro for Indian Govt Jobs (Render Free Tier Ready)
-import os, io, uuid, traceback
-from flask import Flask, render_template_string, request, send_file, jsonify
+import os, io, math, uuid, json, queue, multiprocessing, hashlib, zipfile, resource, threading, functools, contextlib, tracemalloc, traceback
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, namedtuple, defaultdict
+from flask import Flask, render_template_string, request, send_file, jsonify, Response, g, has_request_context
+from werkzeug.http import parse_options_header
 from werkzeug.utils import secure_filename
-from PIL import Image, ImageOps, ImageEnhance, ImageFilter, ImageDraw, ImageFont
+from PIL import Image, ImageOps, ImageEnhance, ImageFilter, ImageDraw, ImageFont, ImageChops, ImageColor
+try:
+    import pillow_avif  # noqa: F401 - registers AVIF with Pillow builds that lack it
+except ImportError:
+    pass
 import time
 
 app = Flask(__name__)
@@ -10,23 +18,36 @@ app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # Reduced to 10MB for free
 app.secret_key = os.environ.get('SECRET_KEY', 'govt-job-tool-2025')
 
 ALLOWED_EXT = {'png','jpg','jpeg','webp','bmp','gif'}
+# decoded format (Image.format) -> extension checked against ALLOWED_EXT
+FORMAT_EXT = {'JPEG': 'jpeg', 'MPO': 'jpeg', 'PNG': 'png', 'WEBP': 'webp', 'BMP': 'bmp', 'GIF': 'gif'}
+
+# Per-upload budgets checked from the image header before any pixels are
+# decoded. JPEGs over max_megapixels are DCT-downscaled on decode instead of
+# rejected when a 1/2, 1/4 or 1/8 scale brings them within budget.
+UploadLimits = namedtuple('UploadLimits', 'max_megapixels max_side max_frames', defaults=(40, 20000, 100))
+DEFAULT_UPLOAD_LIMITS = UploadLimits()
+# Ops that work at full resolution tighten these further (see Op.limits);
+# a request gets the strictest of its route's and its ops' limits.
+FULL_RES_LIMITS = UploadLimits(max_megapixels=24)
+FULL_RES_RGBA_LIMITS = UploadLimits(max_megapixels=16)
+ROUTE_UPLOAD_LIMITS = {
+    'batch': UploadLimits(max_megapixels=24, max_frames=10),
+}
+# Pillow's own bomb check stays as a backstop for anything bigger than
+# max_side allows; it must not pre-empt the JPEG downscale-on-decode path.
+Image.MAX_IMAGE_PIXELS = max(l.max_side for l in [DEFAULT_UPLOAD_LIMITS, *ROUTE_UPLOAD_LIMITS.values()]) ** 2
+TMP_DIR = '/tmp'  # Render allows /tmp
 
 # ---------- Helpers ----------
+class ClientError(ValueError):
+    """A request the client got wrong; answered with a 400 and the message."""
+
 def allowed_filename(filename):
     return '.' in filename and filename.rsplit('.',1)[1].lower() in ALLOWED_EXT
 
-def pil_open_validate(file_stream):
-    try:
-        img = Image.open(file_stream)
-        img.verify()
-        file_stream.seek(0)
-        return True
-    except:
-        return False
-
 def save_temp_bytes(b: bytes, suffix=''):
     name = f"{uuid.uuid4().hex}{suffix}"
-    path = f"/tmp/{name}"  # Render allows /tmp
+    path = os.path.join(TMP_DIR, name)
     with open(path, 'wb') as f:
         f.write(b)
     return path
@@ -35,6 +56,1615 @@ def hex_to_rgb(hex_color):
     hex_color = hex_color.lstrip('#')
     return tuple(int(hex_color[i:i+2], 16) for i in (0, 2, 4))
 
+# ---------- Metrics ----------
+# Per-request stage timings, sizes and memory, exported at /metrics in the
+# Prometheus text format. Outside a request (jobs, batch workers) the
+# helpers below are no-ops.
+METRICS_TRACEMALLOC = os.environ.get('METRICS_TRACEMALLOC') == '1'  # slows every request
+TIME_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+BYTE_BUCKETS = tuple(1024 * 4 ** k for k in range(10))  # 1 KB .. 256 MB
+MEGAPIXEL_BUCKETS = (.1, .3, 1, 3, 6, 12, 24, 48, 100)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30)
+
+class Histogram:
+    """Minimal labelled Prometheus histogram."""
+    def __init__(self, name, help, buckets, labels=('route',)):
+        self.name, self.help, self.buckets, self.labels = name, help, buckets, labels
+        self.lock = threading.Lock()
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.setdefault(label_values, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            items = sorted(self.series.items())
+        for label_values, series in items:
+            labels = ','.join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            sep = ',' if labels else ''
+            for bound, n in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{labels}{sep}le="{bound}"}} {n}')
+            lines.append(f'{self.name}_bucket{{{labels}{sep}le="+Inf"}} {series[-1]}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-2]}')
+            lines.append(f'{self.name}_count{{{labels}}} {series[-1]}')
+        return lines
+
+class Counter:
+    """Minimal labelled Prometheus counter."""
+    def __init__(self, name, help, labels=('route',)):
+        self.name, self.help, self.labels = name, help, labels
+        self.lock = threading.Lock()
+        self.series = defaultdict(int)
+
+    def inc(self, *label_values):
+        with self.lock:
+            self.series[label_values] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            items = sorted(self.series.items())
+        for label_values, n in items:
+            labels = ','.join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            lines.append(f'{self.name}{{{labels}}} {n}')
+        return lines
+
+REQUEST_SECONDS = Histogram('imagemaster_request_seconds', 'Request latency including send.', TIME_BUCKETS)
+STAGE_SECONDS = Histogram('imagemaster_stage_seconds', 'Time per request stage (read, hash, decode, transform, encode, send).',
+                          TIME_BUCKETS, ('route', 'stage'))
+INPUT_BYTES = Histogram('imagemaster_input_bytes', 'Request body size.', BYTE_BUCKETS)
+OUTPUT_BYTES = Histogram('imagemaster_output_bytes', 'Response body size.', BYTE_BUCKETS)
+INPUT_MEGAPIXELS = Histogram('imagemaster_input_megapixels', 'Source image size before any draft decode.', MEGAPIXEL_BUCKETS)
+OUTPUT_MEGAPIXELS = Histogram('imagemaster_output_megapixels', 'Image size handed to the encoder.', MEGAPIXEL_BUCKETS)
+ENCODE_ATTEMPTS = Histogram('imagemaster_encode_attempts', 'Encoder invocations per request, including size-search trials.', COUNT_BUCKETS)
+RSS_GROWTH = Histogram('imagemaster_peak_rss_growth_bytes', 'Rise in the process peak RSS during the request.', BYTE_BUCKETS)
+TRACEMALLOC_PEAK = Histogram('imagemaster_tracemalloc_peak_bytes', 'Peak Python heap growth during the request.', BYTE_BUCKETS)
+UPLOAD_REJECTIONS = Counter('imagemaster_upload_rejections_total', 'Uploads refused by header or output-size validation.',
+                            ('route', 'reason'))
+UPLOAD_DOWNSCALED = Counter('imagemaster_upload_downscaled_total', 'Over-budget JPEGs DCT-downscaled on decode.')
+HISTOGRAMS = [REQUEST_SECONDS, STAGE_SECONDS, INPUT_BYTES, OUTPUT_BYTES, INPUT_MEGAPIXELS,
+              OUTPUT_MEGAPIXELS, ENCODE_ATTEMPTS, RSS_GROWTH, TRACEMALLOC_PEAK]
+COUNTERS = [UPLOAD_REJECTIONS, UPLOAD_DOWNSCALED]
+
+if METRICS_TRACEMALLOC:
+    tracemalloc.start()
+
+def metric_route():
+    return (request.endpoint or 'unknown') if has_request_context() else 'background'
+
+_local = threading.local()  # profile of the request a helper thread works for
+
+def current_profile():
+    return g.get('profile') if has_request_context() else getattr(_local, 'profile', None)
+
+@contextlib.contextmanager
+def stage(name):
+    """Add the time spent in the block to the current request's stage name."""
+    prof = current_profile()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if prof is not None:
+            prof['stages'][name] = prof['stages'].get(name, 0.0) + time.perf_counter() - start
+
+def profile_add(key, value=1):
+    prof = current_profile()
+    if prof is not None:
+        prof['values'][key] = prof['values'].get(key, 0) + value
+
+def peak_rss_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # KB on Linux
+
+def current_rss_bytes():
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+@app.before_request
+def start_profile():
+    g.profile = dict(start=time.perf_counter(), stages={}, values={}, peak_rss=peak_rss_bytes())
+    if METRICS_TRACEMALLOC:
+        tracemalloc.reset_peak()
+        g.profile['traced'] = tracemalloc.get_traced_memory()[0]
+    if request.method == 'POST':
+        with stage('read'):
+            request.files  # parse the multipart body now so it is timed
+
+@app.after_request
+def finish_profile(response):
+    prof = current_profile()
+    if prof is None:
+        return response
+    route = request.endpoint or 'unknown'
+    prof['values']['input_bytes'] = request.content_length or 0
+    if response.content_length is not None:
+        prof['values']['output_bytes'] = response.content_length
+    if METRICS_TRACEMALLOC:
+        prof['values']['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1] - prof['traced']
+    if request.values.get('timing') == '1':
+        response.headers['Server-Timing'] = ', '.join(
+            f'{name};dur={secs * 1000:.1f}' for name, secs in prof['stages'].items())
+    handed_off = time.perf_counter()
+    response.call_on_close(lambda: record_profile(route, prof, handed_off))
+    return response
+
+def record_profile(route, prof, handed_off):
+    """Fold a finished request's profile into the histograms."""
+    now = time.perf_counter()
+    prof['stages']['send'] = now - handed_off
+    REQUEST_SECONDS.observe(now - prof['start'], route)
+    for name, secs in prof['stages'].items():
+        STAGE_SECONDS.observe(secs, route, name)
+    values = prof['values']
+    for hist, key in ((INPUT_BYTES, 'input_bytes'), (OUTPUT_BYTES, 'output_bytes'),
+                      (INPUT_MEGAPIXELS, 'input_megapixels'), (OUTPUT_MEGAPIXELS, 'output_megapixels'),
+                      (TRACEMALLOC_PEAK, 'tracemalloc_peak')):
+        if key in values:
+            hist.observe(values[key], route)
+    if 'input_megapixels' in values:
+        ENCODE_ATTEMPTS.observe(values.get('encode_attempts', 0), route)
+    RSS_GROWTH.observe(peak_rss_bytes() - prof['peak_rss'], route)
+
+def render_metrics():
+    lines = []
+    for metric in HISTOGRAMS + COUNTERS:
+        lines += metric.render()
+    pool = buffer_pool.report()
+    gauges = [('imagemaster_rss_bytes', 'Current resident set size.', current_rss_bytes()),
+              ('imagemaster_peak_rss_bytes', 'Process peak resident set size.', peak_rss_bytes()),
+              ('imagemaster_buffer_pool_idle_bytes', 'Capacity of idle pooled encode buffers.', pool['idle_bytes']),
+              ('imagemaster_buffer_pool_acquired', 'Encode buffers handed out.', pool['acquired']),
+              ('imagemaster_buffer_pool_reused', 'Encode buffers served from the pool.', pool['reused'])]
+    for name, help, value in gauges:
+        lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
+
+# ---------- Pixel ops ----------
+# Band-level operations built on Pillow's native point()/split()/paste() so no
+# route has to walk pixels in Python.
+def to_luma(img):
+    # RGB(A) -> L matches the old RGBA round-trip; other modes go through RGBA
+    if img.mode in ('L', 'RGB', 'RGBA'):
+        return img.convert('L')
+    return img.convert('RGBA').convert('L')
+
+def band_mask(band, test):
+    """Return an 'L' mask that is 255 where test(value) holds and 0 elsewhere."""
+    return band.point([255 if test(v) else 0 for v in range(256)])
+
+def all_above_mask(img, cutoff):
+    """255 where every RGB channel is strictly above cutoff."""
+    r, g, b = img.split()[:3]
+    above = lambda v: v > cutoff
+    mask = ImageChops.multiply(band_mask(r, above), band_mask(g, above))
+    return ImageChops.multiply(mask, band_mask(b, above))
+
+def replace_color(img, mask, color):
+    """Copy of img with every pixel under mask set to color."""
+    out = img.copy()
+    out.paste(color, mask=mask)
+    return out
+
+def key_out_light(img, cutoff=220):
+    """Make near-white pixels fully transparent white; keep everything else."""
+    img = img.convert('RGBA')
+    return replace_color(img, all_above_mask(img, cutoff), (255, 255, 255, 0))
+
+def ink_key(img, threshold=600):
+    """Binarise a signature the way the original route did.
+
+    threshold is compared against r+g+b of the inverted grey image, so pixels
+    lighter than about 55 (the paper) come out opaque black and darker pixels
+    (the ink) come out transparent white. The inversion is kept as-is.
+    """
+    inv = ImageOps.invert(to_luma(img))
+    light = band_mask(inv, lambda v: 3 * v < threshold)
+    dark = ImageOps.invert(light)
+    return Image.merge('RGBA', (dark, dark, dark, light))
+
+# ---------- Loading ----------
+# EXIF orientations that swap width and height
+_SWAPPED_ORIENTATIONS = {5, 6, 7, 8}
+
+class UploadRejected(ClientError):
+    """An upload refused before decoding; status is the HTTP code to answer."""
+    def __init__(self, message, reason, status=413):
+        super().__init__(message)
+        self.reason, self.status = reason, status
+
+def reject_upload(message, reason, status=413):
+    UPLOAD_REJECTIONS.inc(metric_route(), reason)
+    raise UploadRejected(message, reason, status)
+
+def upload_limits(route=None):
+    if route is None and has_request_context():
+        route = request.endpoint
+    return ROUTE_UPLOAD_LIMITS.get(route, DEFAULT_UPLOAD_LIMITS)
+
+def strictest(*limits):
+    """Field-by-field minimum of UploadLimits."""
+    return UploadLimits(*map(min, zip(*limits)))
+
+def pil_open_validate(stream, limits=None):
+    """Open stream reading only the header and check it against limits.
+
+    Returns the lazily-opened image plus the DCT scale (1, 2, 4 or 8) a JPEG
+    must be drafted at to fit the megapixel budget. Raises UploadRejected
+    (counted in UPLOAD_REJECTIONS) for anything else that is too big, of a
+    format outside ALLOWED_EXT, or not an image at all.
+    """
+    limits = limits or upload_limits()
+    try:
+        img = Image.open(stream)
+    except Image.DecompressionBombError as e:
+        reject_upload(str(e), 'megapixels')
+    except (OSError, SyntaxError, ValueError):
+        reject_upload('not a readable image', 'corrupt', 400)
+    if FORMAT_EXT.get(img.format) not in ALLOWED_EXT:
+        reject_upload(f'unsupported image format {img.format}', 'format', 415)
+    w, h = img.size
+    if max(w, h) > limits.max_side or min(w, h) < 1:
+        reject_upload(f'image is {w}x{h}; the longest side may be at most {limits.max_side}px', 'dimensions')
+    if getattr(img, 'n_frames', 1) > limits.max_frames:
+        reject_upload(f'image has {img.n_frames} frames; at most {limits.max_frames} allowed', 'frames')
+    scale = 1
+    while w * h / scale ** 2 > limits.max_megapixels * 1e6:
+        scale *= 2
+    if scale > 1 and (img.format not in ('JPEG', 'MPO') or scale > 8):
+        reject_upload(f'image is {w * h / 1e6:.1f} MP; at most {limits.max_megapixels} MP allowed', 'megapixels')
+    return img, scale
+
+def load_image(stream, mode='RGB', target=None, limits=None):
+    """Decode an upload no larger than needed for a (w, h) output target.
+
+    The header is validated first (see pil_open_validate). JPEGs are
+    DCT-scaled via draft() so the full-resolution buffer is never allocated,
+    either down to the route's target or as far as the upload budget
+    demands; everything is then reduce()d to within 2x of the target so the
+    final LANCZOS pass stays cheap. EXIF orientation is always applied.
+    """
+    img, scale = pil_open_validate(stream, limits)
+    profile_add('input_megapixels', img.width * img.height / 1e6)
+    if img.format in ('JPEG', 'MPO'):
+        size = target
+        if target and img.getexif().get(0x0112) in _SWAPPED_ORIENTATIONS:
+            size = (target[1], target[0])
+        if scale > 1:
+            UPLOAD_DOWNSCALED.inc(metric_route())
+            budget = (img.width // scale, img.height // scale)
+            if size is None or budget[0] * budget[1] < size[0] * size[1]:
+                size = budget
+        img.draft(mode if mode in ('L', 'RGB') else 'RGB', size)
+    img = img.convert(mode)
+    ImageOps.exif_transpose(img, in_place=True)
+    if target:
+        img = prescale(img, target)
+    return img
+
+def prescale(img, target, gap=2):
+    """Integer box-reduce img while it stays at least gap x target."""
+    factor = min(img.width // (gap * target[0]), img.height // (gap * target[1]))
+    return img.reduce(factor) if factor > 1 else img
+
+# ---------- Buffers ----------
+# Encoders write into pooled bytearrays instead of a fresh BytesIO per
+# request (or per quality-search step), so concurrent requests recycle a
+# few multi-megabyte blocks rather than fragmenting the heap.
+BUFFER_POOL_MB = int(os.environ.get('BUFFER_POOL_MB', 16))  # idle bytes kept; 0 disables pooling
+STREAM_RESPONSES = os.environ.get('STREAM_RESPONSES', '1') != '0'
+STREAM_CHUNK = 64 * 1024
+STREAM_QUEUE = 16  # writes (mostly 64 KB) an encode may run ahead of the socket
+
+class PooledBuffer:
+    """Seekable in-memory file over a bytearray that is reused, not shrunk."""
+    def __init__(self):
+        self.data = bytearray()
+        self.size = self.pos = 0
+
+    def write(self, b):
+        end = self.pos + len(b)
+        self.data[self.pos:end] = b  # grows the bytearray only past its high-water mark
+        self.pos, self.size = end, max(self.size, end)
+        return len(b)
+
+    def read(self, n=-1):
+        end = self.size if n is None or n < 0 else min(self.size, self.pos + n)
+        with memoryview(self.data) as view:
+            out = bytes(view[self.pos:end])
+        self.pos = max(self.pos, end)
+        return out
+
+    def seek(self, pos, whence=0):
+        self.pos = max(0, pos + (0, self.pos, self.size)[whence])
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def truncate(self, size=None):
+        self.size = self.pos if size is None else size
+        return self.size
+
+    def flush(self):
+        pass
+
+    def getbuffer(self):
+        """Zero-copy view of the contents; release it before the next write."""
+        return memoryview(self.data)[:self.size]
+
+    def getvalue(self):
+        with self.getbuffer() as view:
+            return bytes(view)
+
+class BufferPool:
+    """Bounded free list of PooledBuffers.
+
+    acquire() never blocks: it reuses an idle buffer or makes a new one.
+    release() keeps buffers while their combined capacity stays within
+    max_bytes and drops the rest, so one huge output does not pin memory.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.idle = []
+        self.idle_bytes = 0
+        self.stats = dict(acquired=0, reused=0, dropped=0)
+
+    def acquire(self):
+        with self.lock:
+            self.stats['acquired'] += 1
+            buf = self.idle.pop() if self.idle else None
+            if buf is not None:
+                self.idle_bytes -= len(buf.data)
+                self.stats['reused'] += 1
+        buf = buf or PooledBuffer()
+        buf.seek(0)
+        buf.truncate(0)
+        return buf
+
+    def release(self, buf):
+        if not isinstance(buf, PooledBuffer):
+            return
+        with self.lock:
+            if any(b is buf for b in self.idle):
+                return
+            if self.idle_bytes + len(buf.data) <= self.max_bytes:
+                self.idle.append(buf)
+                self.idle_bytes += len(buf.data)
+            else:
+                self.stats['dropped'] += 1
+
+    def report(self):
+        with self.lock:
+            return dict(self.stats, idle=len(self.idle), idle_bytes=self.idle_bytes)
+
+buffer_pool = BufferPool(BUFFER_POOL_MB * 1024 * 1024)
+
+def iter_buffer(buf, chunk=STREAM_CHUNK):
+    """Yield a pooled buffer's contents in chunks, then return it to the pool.
+
+    WSGI servers only take bytes, so each chunk is copied out of a
+    memoryview slice; at most one chunk is duplicated at a time.
+    """
+    try:
+        with buf.getbuffer() as view:
+            for start in range(0, len(view), chunk):
+                yield bytes(view[start:start + chunk])
+    finally:
+        buffer_pool.release(buf)
+
+class _QueueWriter:
+    """File-like that hands each write to a consumer through a bounded queue."""
+    def __init__(self, chunks, cancelled):
+        self.chunks, self.cancelled = chunks, cancelled
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise OSError('client went away')
+            try:
+                return self.chunks.put(item, timeout=1)
+            except queue.Full:
+                pass
+
+    def write(self, b):
+        self.put(b if isinstance(b, bytes) else bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+_STREAM_END = object()
+
+def stream_encode(encode, prof=None):
+    """Yield what encode(fp) writes, as it is written.
+
+    encode runs on its own thread, at most STREAM_QUEUE writes ahead of
+    the consumer, so the full output never has to sit in memory. Closing
+    the generator early makes the next write raise, which stops the
+    encode. prof, if given, receives the encode's stage timings.
+    """
+    chunks, cancelled = queue.Queue(maxsize=STREAM_QUEUE), threading.Event()
+    writer, failure = _QueueWriter(chunks, cancelled), []
+
+    def run():
+        _local.profile = prof
+        try:
+            encode(writer)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            with contextlib.suppress(OSError):
+                writer.put(_STREAM_END)
+
+    threading.Thread(target=run, name='stream-encode', daemon=True).start()
+    sent = 0
+    try:
+        while True:
+            item = chunks.get()
+            if item is _STREAM_END:
+                break
+            sent += len(item)
+            yield item
+        if failure:
+            raise failure[0]
+    finally:
+        cancelled.set()
+        if prof is not None:
+            prof['values']['output_bytes'] = sent
+
+# ---------- Encoder settings ----------
+# Save options are picked from a cheap look at the content rather than
+# hard-coded per route.
+Content = namedtuple('Content', 'gray flat')
+GRAY_TOLERANCE = 3          # max distance of Cb/Cr from neutral for a grey image
+FLAT_SHARE = 0.5            # share of paper-white pixels that makes a page or document
+FLAT_MAX_QUALITY = 90       # white paper is free at any quality; 95 only inflates the rest
+WEBP_METHOD = 0             # fastest; still smaller than JPEG at the same quality
+AVIF_SPEED = 8
+
+def can_save(fmt):
+    Image.init()  # WebP/AVIF writers register only once every plugin is loaded
+    return fmt in Image.SAVE
+
+def is_gray(img, rows=256):
+    """True if every pixel's Cb/Cr is within GRAY_TOLERANCE of neutral.
+
+    Checked at full resolution, a strip of rows at a time, stopping at the
+    first strip with colour: a thin coloured line or a blue-ink signature
+    must never be lost to a sampled thumbnail.
+    """
+    if img.mode in ('L', 'LA', '1'):
+        return True
+    for top in range(0, img.height, rows):
+        strip = img.crop((0, top, img.width, min(img.height, top + rows)))
+        _, cb, cr = strip.convert('RGB').convert('YCbCr').getextrema()
+        if not all(128 - GRAY_TOLERANCE <= lo and hi <= 128 + GRAY_TOLERANCE for lo, hi in (cb, cr)):
+            return False
+    return True
+
+def analyse(img, side=128):
+    """Content summary of img; flat is judged from a thumbnail, gray is not."""
+    scale = min(1.0, side / max(img.size))
+    thumb = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.NEAREST)
+    hist = thumb.convert('L').histogram()
+    flat = sum(hist[240:]) >= FLAT_SHARE * thumb.width * thumb.height
+    return Content(is_gray(img), flat)
+
+def save_options(img, fmt='JPEG', quality=95, optimize=False, progressive=False):
+    """Return (img, save kwargs) for a lossy encode of img as fmt.
+
+    Grey content is encoded as a single-channel JPEG; colour keeps
+    Pillow's 4:2:0 chroma, since 4:4:4 costs 50-70% more bytes at the same
+    quality. WebP and AVIF keep any alpha channel. Mostly-white pages and
+    documents are capped at FLAT_MAX_QUALITY. Progressive JPEG is only used
+    on request: it costs about twice the encode time of optimize=True for
+    3-4% fewer bytes.
+    """
+    content = analyse(img)
+    if fmt == 'JPEG':
+        mode = 'L' if content.gray else 'RGB'
+    else:
+        mode = 'RGBA' if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info else 'RGB'
+    if img.mode != mode:
+        img = img.convert(mode)
+    if content.flat:
+        quality = min(quality, FLAT_MAX_QUALITY)
+    if fmt == 'WEBP':
+        return img, dict(quality=quality, method=WEBP_METHOD)
+    if fmt == 'AVIF':
+        return img, dict(quality=quality, speed=AVIF_SPEED)
+    save_kw = dict(quality=quality)
+    if progressive:
+        save_kw['progressive'] = True  # implies optimized Huffman tables
+    elif optimize:
+        save_kw['optimize'] = True
+    return img, save_kw
+
+# ---------- Size-targeted encoding ----------
+PROBE_QUALITIES = (95, 80, 60, 40, 25, 10)
+
+def _save(img, buf, fmt, quality=None):
+    profile_add('encode_attempts')
+    buf.seek(0)
+    buf.truncate(0)
+    if quality is None:
+        img.save(buf, fmt, optimize=True)
+    else:
+        img.save(buf, fmt, quality=quality, optimize=True)
+    return buf.tell()
+
+def _size_model(img, fmt, qmin, qmax):
+    """Estimate encoded size per quality from trial encodes of a 1/16-area copy.
+
+    Returns a function q -> estimated bytes (piecewise linear between the
+    probe qualities), or None when the image is too small to be worth it.
+    """
+    factor = min(4, img.width // 64, img.height // 64)
+    if factor < 2:
+        return None
+    small = img.reduce(factor)
+    buf = buffer_pool.acquire()
+    qs = sorted({max(qmin, min(qmax, q)) for q in PROBE_QUALITIES})
+    points = [(q, _save(small, buf, fmt, q) * factor * factor) for q in qs]
+    buffer_pool.release(buf)
+    def estimate(q):
+        for (q0, s0), (q1, s1) in zip(points, points[1:]):
+            if q <= q1:
+                return s0 + (s1 - s0) * (q - q0) / ((q1 - q0) or 1)
+        return points[-1][1]
+    return estimate
+
+def _pick_quality(estimate, budget, qmin, qmax):
+    fitting = [q for q in range(qmin, qmax + 1) if estimate(q) <= budget]
+    return max(fitting) if fitting else qmin
+
+def _next_quality(sizes, max_bytes, lo, hi, estimate, bisect=False):
+    """Quality to try next, strictly between lo (fits) and hi (too big).
+
+    With both ends measured, interpolate log(size) across the bracket;
+    with one, rescale the trial-encode model to that measurement.
+    """
+    if bisect or (estimate is None and not (lo in sizes and hi in sizes)):
+        q = (lo + hi) // 2
+    elif lo in sizes and hi in sizes:
+        a, b = math.log(sizes[lo]), math.log(sizes[hi])
+        q = lo + (hi - lo) * (math.log(max_bytes) - a) / (b - a)
+    else:
+        known = lo if lo in sizes else hi if hi in sizes else None
+        budget = max_bytes if known is None else max_bytes * estimate(known) / sizes[known]
+        q = _pick_quality(estimate, budget, lo + 1, hi - 1)
+    return min(hi - 1, max(lo + 1, int(q)))
+
+def _search_quality(img, max_bytes, fmt, qmin, qmax, best, trial):
+    """Find the highest quality in [qmin, qmax] whose encode fits max_bytes.
+
+    Returns (quality or None, best, trial, sizes) with the winning encode in
+    best. Falls back to plain bisection when the same bracket end moves
+    twice in a row, so a badly shaped curve cannot stall the search.
+    """
+    estimate = _size_model(img, fmt, qmin, qmax)
+    sizes, lo, hi = {}, qmin - 1, qmax + 1
+    last, streak = None, 0
+    while hi - lo > 1:
+        q = _next_quality(sizes, max_bytes, lo, hi, estimate, bisect=streak >= 2)
+        sizes[q] = _save(img, trial, fmt, q)
+        side = 'lo' if sizes[q] <= max_bytes else 'hi'
+        if side == 'lo':
+            best, trial, lo = trial, best, q
+        else:
+            hi = q
+        streak = streak + 1 if side == last else 1
+        last = side
+    return (lo if lo >= qmin else None), best, trial, sizes
+
+def encode_to_size(img, max_bytes, fmt='JPEG', qmin=10, qmax=95, min_side=16):
+    """Encode img as fmt in at most max_bytes at the highest quality that fits.
+
+    A low-resolution trial encode predicts the size/quality curve and real
+    encodes narrow the bracket by interpolation, so a request typically
+    costs 3-5 full encodes. When even qmin is too big (or fmt has no quality
+    knob, e.g. PNG) the image is downscaled and the search repeated.
+    Raises ClientError if nothing fits. Both working buffers come from
+    buffer_pool; the one returned is the caller's to release.
+    """
+    if max_bytes <= 0:
+        raise ClientError(f'target size must be positive, not {max_bytes} bytes')
+    best, trial = buffer_pool.acquire(), buffer_pool.acquire()
+    while True:
+        if fmt == 'PNG':
+            smallest = _save(img, best, fmt)
+            if smallest <= max_bytes:
+                break
+        else:
+            quality, best, trial, sizes = _search_quality(img, max_bytes, fmt, qmin, qmax, best, trial)
+            if quality is not None:
+                break
+            smallest = sizes[qmin]
+        if min(img.size) <= min_side:
+            buffer_pool.release(best)
+            buffer_pool.release(trial)
+            raise ClientError(f'cannot encode image as {fmt} within {max_bytes} bytes')
+        scale = 0.9 * (max_bytes / smallest) ** 0.5
+        w = max(min_side, int(img.width * scale))
+        h = max(min_side, int(img.height * scale))
+        img = img.resize((w, h), Image.LANCZOS)
+    buffer_pool.release(trial)
+    best.seek(0)
+    return best
+
+# ---------- Sheet layouts ----------
+A4_300DPI = (2480, 3508)
+SHEET_POOL_PAGES = int(os.environ.get('SHEET_POOL_PAGES', 2))  # idle blank pages kept across all layouts (~35 MB each at A4)
+
+# tile is the photo size in px; positions are top-left corners on the page
+SheetLayout = namedtuple('SheetLayout', 'tile positions cut_marks page', defaults=(A4_300DPI,))
+
+def mm_to_px(mm, dpi=300):
+    return round(mm * dpi / 25.4)
+
+def grid_layout(tile_mm, margin_mm=10, gap_mm=5, count=None, cut_marks=True, page=A4_300DPI, dpi=300):
+    """Fill the page row by row with tile_mm photos, up to count of them."""
+    tile = (mm_to_px(tile_mm[0], dpi), mm_to_px(tile_mm[1], dpi))
+    margin, gap = mm_to_px(margin_mm, dpi), mm_to_px(gap_mm, dpi)
+    cols = (page[0] - 2 * margin + gap) // (tile[0] + gap)
+    rows = (page[1] - 2 * margin + gap) // (tile[1] + gap)
+    count = cols * rows if count is None else count
+    if count > cols * rows:
+        raise ClientError(f'{count} tiles of {tile_mm} mm do not fit on the page')
+    positions = [(margin + (i % cols) * (tile[0] + gap), margin + (i // cols) * (tile[1] + gap))
+                 for i in range(count)]
+    return SheetLayout(tile, positions, cut_marks, page)
+
+SHEET_LAYOUTS = {
+    # the original six-up sheets, kept pixel-identical
+    'passport': SheetLayout((413, 531), [(100,100), (600,100), (1100,100), (1600,100), (100,700), (600,700)], False),
+    'printsheet': SheetLayout((413, 531), [(200,150),(800,150),(1400,150),(200,800),(800,800),(1400,800)], False),
+    '35x45mm': grid_layout((35, 45)),
+    '2x2in': grid_layout((50.8, 50.8)),
+    '25x35mm': grid_layout((25, 35)),
+    '20x25mm': grid_layout((20, 25)),
+}
+
+def get_layout(name):
+    if name not in SHEET_LAYOUTS:
+        raise ClientError(f'unknown sheet layout {name!r}')
+    return SHEET_LAYOUTS[name]
+
+def render_blank(layout):
+    """White page with optional grey cut marks just outside each tile corner."""
+    page = Image.new('RGB', layout.page, 'white')
+    if layout.cut_marks:
+        draw = ImageDraw.Draw(page)
+        mark, off = mm_to_px(3), mm_to_px(1)
+        for x, y in layout.positions:
+            w, h = layout.tile
+            for cx, dx in ((x, -1), (x + w, 1)):
+                for cy, dy in ((y, -1), (y + h, 1)):
+                    draw.line([(cx + dx * off, cy), (cx + dx * (off + mark), cy)], fill='#999999', width=2)
+                    draw.line([(cx, cy + dy * off), (cx, cy + dy * (off + mark))], fill='#999999', width=2)
+    return page
+
+_sheet_pages = []  # idle (name, page) pairs, least recently returned first
+_sheet_pages_lock = threading.Lock()
+
+@contextlib.contextmanager
+def blank_page(name):
+    """Borrow a blank page for layout name, rendering one if none is idle.
+
+    Returned pages are kept for reuse, so callers must leave them blank
+    again (see render_sheet). At most SHEET_POOL_PAGES stay idle in total,
+    whatever the layout; the least recently returned are dropped first.
+    """
+    with _sheet_pages_lock:
+        idle = [i for i, (n, _) in enumerate(_sheet_pages) if n == name]
+        page = _sheet_pages.pop(idle[-1])[1] if idle else None
+    if page is None:
+        page = render_blank(get_layout(name))
+    try:
+        yield page
+    finally:
+        with _sheet_pages_lock:
+            _sheet_pages.append((name, page))
+            if len(_sheet_pages) > SHEET_POOL_PAGES:
+                del _sheet_pages[0]
+
+def render_sheet(img, name, quality=95, out=None):
+    """Encode layout name with img pasted into every tile, as JPEG.
+
+    Only the tile regions are touched: they are composited onto a pooled
+    blank page, the page is encoded, and the tiles are wiped back to white,
+    so no request allocates its own full-page canvas. Save options come
+    from the page as a whole (see save_options). Writes to out if given,
+    else to a pooled buffer.
+    """
+    layout = get_layout(name)
+    boxes = [(x, y, x + img.width, y + img.height) for x, y in layout.positions]
+    buf = buffer_pool.acquire() if out is None else out
+    with blank_page(name) as page:
+        try:
+            for box in boxes:
+                page.paste(img, box[:2])
+            flat, save_kw = save_options(page, quality=quality)
+            profile_add('encode_attempts')
+            flat.save(buf, 'JPEG', **save_kw)
+        finally:
+            for box in boxes:
+                page.paste('white', box)
+    if out is None:
+        buf.seek(0)
+    return buf
+
+# ---------- Operations ----------
+# Image -> Image helpers behind the pipeline ops below.
+def fit_photo(img, layout='passport'):
+    """Crop and scale to the tile size of a sheet layout."""
+    return ImageOps.fit(img, get_layout(layout).tile, Image.LANCZOS)
+
+def add_border(img, width=40, color='white'):
+    return ImageOps.expand(img, border=width, fill=color)
+
+def contrast_lut(mean, factor):
+    """ImageEnhance.Contrast as a 256-entry table for an image of this mean."""
+    ramp = Image.frombytes('L', (256, 1), bytes(range(256)))
+    return list(Image.blend(Image.new('L', (256, 1), mean), ramp, factor).getdata())
+
+def clean_signature(img, threshold=600, bg='white', size=(400, 150)):
+    """Ink-key a signature, resize it and optionally flatten onto white."""
+    img = ink_key(img, threshold).resize(tuple(size), Image.LANCZOS)
+    if bg == 'white':
+        flat = Image.new('RGB', img.size, 'white')
+        flat.paste(img, mask=img)
+        img = flat
+    return img
+
+def encode_image(img, fmt='JPEG', out=None, **save_kw):
+    """Save img into out if given, else into a pooled buffer, and return it."""
+    profile_add('encode_attempts')
+    if out is not None:
+        img.save(out, fmt, **save_kw)
+        return out
+    buf = buffer_pool.acquire()
+    img.save(buf, fmt, **save_kw)
+    buf.seek(0)
+    return buf
+
+# ---------- Pipeline ----------
+MIMETYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp', 'AVIF': 'image/avif'}
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'AVIF': 'avif'}
+
+class Op:
+    """One pipeline stage: apply(img) returns the next image.
+
+    Ops that define lut(hist) are pixel-wise on 'L' images; runs of them are
+    fused into a single point() pass. decode_mode/decode_target let the
+    first op pick how small the upload can be decoded. heavy ops count
+    against the job queue's capacity even when run synchronously. limits,
+    if set, caps the uploads a pipeline containing the op accepts.
+    """
+    decode_mode = None
+    decode_target = None
+    needs_alpha = False
+    heavy = False
+    limits = None
+    lut = None
+
+    def apply(self, img):
+        raise NotImplementedError
+
+    def output_size(self, size):
+        """(w, h) that apply() returns for an image of size."""
+        return size
+
+    def __repr__(self):
+        return f'{type(self).__name__}({vars(self)})'
+
+class Fit(Op):
+    def __init__(self, layout='passport'):
+        self.layout = layout
+        self.decode_target = get_layout(layout).tile
+
+    def apply(self, img):
+        return fit_photo(img, self.layout)
+
+    def output_size(self, size):
+        return self.decode_target
+
+class Border(Op):
+    MAX_WIDTH = 400
+    limits = FULL_RES_LIMITS
+
+    def __init__(self, width=40, color='white'):
+        self.width, self.color = min(max(int(width), 0), self.MAX_WIDTH), color
+        ImageColor.getrgb(color)  # raises ValueError for unknown colours
+
+    def apply(self, img):
+        return add_border(img, self.width, self.color)
+
+    def output_size(self, size):
+        return size[0] + 2 * self.width, size[1] + 2 * self.width
+
+class Grayscale(Op):
+    decode_mode = 'L'
+    limits = FULL_RES_LIMITS
+
+    def __init__(self, contrast=1.0):
+        self.contrast = float(contrast)
+
+    def lut(self, hist):
+        if self.contrast == 1.0:
+            return list(range(256))
+        mean = sum(i * n for i, n in enumerate(hist)) / (sum(hist) or 1)
+        return contrast_lut(int(mean + 0.5), self.contrast)
+
+class Threshold(Op):
+    decode_mode = 'L'
+    limits = FULL_RES_LIMITS
+
+    def __init__(self, cutoff=128):
+        self.cutoff = int(cutoff)
+
+    def lut(self, hist):
+        return [255 if v >= self.cutoff else 0 for v in range(256)]
+
+class KeyOut(Op):
+    needs_alpha = heavy = True
+    limits = FULL_RES_RGBA_LIMITS
+
+    def __init__(self, threshold=220):
+        self.threshold = int(threshold)
+
+    def apply(self, img):
+        return key_out_light(img, self.threshold)
+
+class Signature(Op):
+    needs_alpha = heavy = True
+
+    MAX_SIDE = 2000
+
+    def __init__(self, threshold=600, bg='white', size=(400, 150)):
+        w, h = size
+        self.threshold, self.bg = int(threshold), bg
+        self.size = tuple(min(max(int(v), 1), self.MAX_SIDE) for v in (w, h))
+        self.decode_target = self.size
+
+    def apply(self, img):
+        return clean_signature(img, self.threshold, self.bg, self.size)
+
+    def output_size(self, size):
+        return self.size
+
+class Encoder(Op):
+    """Final stage: apply(img, out=None) encodes instead of returning an image.
+
+    The output goes to the writable file out when given, else to a pooled
+    buffer; either way it is returned. Streamable encoders write their
+    output progressively, so it can go straight to the client.
+    """
+    fmt = 'JPEG'
+    streamable = True
+
+    @property
+    def mimetype(self):
+        return MIMETYPES[self.fmt]
+
+    @property
+    def ext(self):
+        return EXTENSIONS[self.fmt]
+
+class Jpeg(Encoder):
+    def __init__(self, quality=95, optimize=False, progressive=False):
+        self.quality, self.optimize, self.progressive = int(quality), bool(optimize), bool(progressive)
+
+    @property
+    def limits(self):
+        # optimize/progressive make Pillow buffer a whole frame's worth of output
+        return FULL_RES_LIMITS if self.optimize or self.progressive else None
+
+    def apply(self, img, out=None):
+        img, save_kw = save_options(img, 'JPEG', self.quality, self.optimize, self.progressive)
+        return encode_image(img, out=out, **save_kw)
+
+class Webp(Encoder):
+    """Lossy WebP, or AVIF with fmt='AVIF' where Pillow can write it."""
+    def __init__(self, quality=85, fmt='WEBP'):
+        self.quality, self.fmt = int(quality), fmt.upper()
+        if self.fmt not in ('WEBP', 'AVIF') or not can_save(self.fmt):
+            raise ClientError(f'unsupported format {fmt!r}')
+        if not 0 <= self.quality <= 100:
+            raise ClientError(f'quality must be between 0 and 100, not {self.quality}')
+
+    def apply(self, img, out=None):
+        img, save_kw = save_options(img, self.fmt, self.quality)
+        return encode_image(img, self.fmt, out, **save_kw)
+
+class Png(Encoder):
+    fmt = 'PNG'
+
+    def apply(self, img, out=None):
+        return encode_image(img, 'PNG', out)
+
+class EncodeToSize(Encoder):
+    streamable = False  # every candidate is encoded in full before one is picked
+    heavy = True
+    limits = FULL_RES_LIMITS
+
+    def __init__(self, targetkb, format='JPEG'):
+        self.max_bytes, self.fmt = int(targetkb) * 1024, format.upper()
+        if self.max_bytes <= 0:
+            raise ClientError(f'target size must be at least 1 KB, not {targetkb}')
+        if self.fmt not in MIMETYPES:
+            raise ClientError(f'unsupported format {format!r}')
+
+    def apply(self, img, out=None):
+        if self.fmt != 'PNG':
+            img = img.convert('L' if analyse(img).gray else 'RGB')
+        buf = encode_to_size(img, self.max_bytes, self.fmt)
+        if out is None:
+            return buf
+        with buf.getbuffer() as view:
+            out.write(view)
+        buffer_pool.release(buf)
+        return out
+
+class Sheet(Encoder):
+    streamable = False  # streaming would hold a pooled blank page for as long as the client reads
+
+    def __init__(self, layout='printsheet', quality=95):
+        self.layout, self.quality = layout, int(quality)
+        self.decode_target = get_layout(layout).tile
+
+    def apply(self, img, out=None):
+        if img.size != self.decode_target:
+            img = fit_photo(img, self.layout)
+        return render_sheet(img.convert('RGB'), self.layout, self.quality, out)
+
+    def output_size(self, size):
+        return get_layout(self.layout).page
+
+PIPELINE_OPS = {
+    'fit': Fit,
+    'border': Border,
+    'grayscale': Grayscale,
+    'scanner': functools.partial(Grayscale, contrast=3.0),
+    'threshold': Threshold,
+    'key_out': KeyOut,
+    'remove_bg': KeyOut,
+    'signature': Signature,
+    'jpeg': Jpeg,
+    'compress': functools.partial(Jpeg, quality=85, optimize=True),
+    'webp': Webp,
+    'avif': functools.partial(Webp, fmt='AVIF'),
+    'png': Png,
+    'encode_to_size': EncodeToSize,
+    'resizekb': EncodeToSize,
+    'sheet': Sheet,
+}
+
+def _apply_luts(img, ops):
+    """Run consecutive pixel-wise ops as one composed lookup table."""
+    if img.mode != 'L':
+        img = img.convert('L')
+    hist = img.histogram()
+    table = list(range(256))
+    for op in ops:
+        step = op.lut(hist)
+        table = [step[v] for v in table]
+        moved = [0] * 256
+        for v, n in enumerate(hist):
+            moved[step[v]] += n
+        hist = moved
+    return img.point(table)
+
+class Pipeline:
+    """Decode once, run ops on one in-memory image, encode once."""
+    def __init__(self, ops, limits=None):
+        if not ops:
+            raise ClientError('pipeline needs at least one op')
+        if any(isinstance(op, Encoder) for op in ops[:-1]):
+            raise ClientError('only the last op may encode')
+        self.ops = list(ops)
+        self.limits = strictest(limits or upload_limits(), *(op.limits for op in ops if op.limits))
+
+    @property
+    def heavy(self):
+        return any(op.heavy for op in self.ops)
+
+    @classmethod
+    def from_spec(cls, spec, limits=None):
+        """Build from ["fit", {"op": "resizekb", "targetkb": 50}, ...]."""
+        if isinstance(spec, dict):
+            spec = spec.get('ops')
+        if not isinstance(spec, list):
+            raise ClientError('ops must be a list')
+        ops = []
+        for item in spec:
+            params = {'op': item} if isinstance(item, str) else dict(item) if isinstance(item, dict) else {}
+            name = params.pop('op', None)
+            if name not in PIPELINE_OPS:
+                raise ClientError(f'unknown op {name!r}')
+            try:
+                ops.append(PIPELINE_OPS[name](**params))
+            except ClientError:
+                raise
+            except (TypeError, ValueError) as e:
+                raise ClientError(f'bad parameters for {name!r}: {e}') from None
+        return cls(ops, limits)
+
+    def decode(self, stream):
+        first = self.ops[0]
+        mode = 'RGBA' if any(op.needs_alpha for op in self.ops) else first.decode_mode or 'RGB'
+        return load_image(stream, mode, first.decode_target, self.limits)
+
+    def stages(self):
+        """Group ops into runnable stages, fusing neighbouring lut ops."""
+        stages = []
+        for op in self.ops:
+            if isinstance(op, Encoder):
+                continue
+            if op.lut is not None and stages and isinstance(stages[-1], list):
+                stages[-1].append(op)
+            else:
+                stages.append([op] if op.lut is not None else op)
+        return stages
+
+    def render(self, stream, progress=None, total=None):
+        """Decode and run every non-encoding op; return the final image."""
+        stages = self.stages()
+        total = total or len(stages) + 1
+        report = progress or (lambda done, total: None)
+        with stage('decode'):
+            img = self.decode(stream)
+        self.check_output(img.size)
+        report(1, total)
+        with stage('transform'):
+            for i, step in enumerate(stages, 2):
+                img = _apply_luts(img, step) if isinstance(step, list) else step.apply(img)
+                report(i, total)
+        return img
+
+    def check_output(self, size):
+        """Reject the upload if any op would grow it past max_megapixels."""
+        for op in self.ops:
+            size = op.output_size(size)
+            if size[0] * size[1] > self.limits.max_megapixels * 1e6:
+                reject_upload(f'{type(op).__name__} would produce a {size[0]}x{size[1]} image; '
+                              f'at most {self.limits.max_megapixels} MP allowed', 'output')
+
+    def negotiate(self, fmt):
+        """Swap a final Jpeg encoder for Webp(fmt=fmt); True if swapped."""
+        if fmt is None or type(self.ops[-1]) is not Jpeg:
+            return False
+        self.ops[-1] = Webp(self.ops[-1].quality, fmt)
+        return True
+
+    def encoder_for(self, img):
+        """The final op, or a default encoder for the rendered img."""
+        encoder = self.ops[-1]
+        if not isinstance(encoder, Encoder):
+            encoder = Png() if img.mode in ('RGBA', 'LA') else Jpeg()
+        return encoder
+
+    def encode(self, img, out=None):
+        """Encode a rendered img into out (or a pooled buffer); returns it."""
+        profile_add('output_megapixels', img.width * img.height / 1e6)
+        with stage('encode'):
+            return self.encoder_for(img).apply(img, out)
+
+    def run(self, stream, progress=None, out=None):
+        """Return (encoded buffer, encoder) for the upload in stream.
+
+        The output goes to out if given, else to a pooled buffer that the
+        caller should hand back to buffer_pool. progress, if given, is
+        called as progress(done, total) after the decode, each stage and
+        the encode.
+        """
+        total = len(self.stages()) + 2
+        report = progress or (lambda done, total: None)
+        img = self.render(stream, report, total)
+        buf = self.encode(img, out)
+        report(total, total)
+        return buf, self.encoder_for(img)
+
+NEGOTIATED_FORMATS = ('AVIF', 'WEBP')  # preferred first
+
+def negotiated_format():
+    """Format the client explicitly accepts in place of JPEG, or None.
+
+    Browsers list image/webp in the Accept header of ordinary page loads
+    too, so requests that accept text/html keep their .jpg downloads.
+    """
+    accepted = {value for value, q in request.accept_mimetypes if q > 0}
+    if 'text/html' in accepted:
+        return None
+    for fmt in NEGOTIATED_FORMATS:
+        if MIMETYPES[fmt] in accepted and can_save(fmt):
+            return fmt
+    return None
+
+# ---------- Presets ----------
+# Op lists behind the single-purpose routes, built from their form fields.
+def preset(build):
+    """Report form fields build(form) cannot parse as a ClientError."""
+    @functools.wraps(build)
+    def wrapper(form):
+        try:
+            return build(form)
+        except ClientError:
+            raise
+        except (TypeError, ValueError) as e:
+            raise ClientError(f'bad form field: {e}') from None
+    return wrapper
+
+@preset
+def passport_ops(form):
+    layout = form.get('layout', 'passport')  # 35mm x 45mm at 300 DPI by default
+    return [Fit(layout), Sheet(layout)]
+
+@preset
+def printsheet_ops(form):
+    layout = form.get('layout', 'printsheet')
+    return [Fit(layout), Sheet(layout)]
+
+@preset
+def signature_ops(form):
+    bg_type = form.get('bg', 'white')
+    max_kb = int(form.get('maxkb', 20))
+    return [Signature(form.get('threshold', 600), bg_type),
+            EncodeToSize(max_kb, 'PNG' if bg_type == 'transparent' else 'JPEG')]
+
+@preset
+def scanner_ops(form):
+    return [Grayscale(contrast=3.0), Jpeg(quality=95)]
+
+@preset
+def resizekb_ops(form):
+    if 'targetkb' not in form:
+        raise ClientError('targetkb is required')
+    return [EncodeToSize(form['targetkb'])]
+
+@preset
+def border_ops(form):
+    return [Border(40, 'white'), Jpeg(quality=95)]
+
+@preset
+def bg_remove_ops(form):
+    return [KeyOut(form.get('threshold', 220)), Png()]
+
+@preset
+def compress_ops(form):
+    return [Jpeg(quality=85, optimize=True)]
+
+# ---------- Result cache ----------
+# Bump when a change to any route alters its output for the same input.
+CACHE_VERSION = '2'
+CACHE_IGNORED_FIELDS = {'async', 'timing'}  # form fields that do not change the output
+
+class ResultCache:
+    """Content-addressed response cache: in-memory LRU plus optional disk tier.
+
+    Both tiers are bounded in bytes and evict least-recently-used entries.
+    The disk tier is disabled when disk_bytes is 0.
+    """
+    def __init__(self, memory_bytes, disk_bytes=0, disk_dir=None):
+        self.memory_bytes, self.disk_bytes = memory_bytes, disk_bytes
+        self.disk_dir = disk_dir or os.path.join(TMP_DIR, 'imagemaster-cache')
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (headers, body)
+        self.used = 0
+        self.disk_used = 0
+        self.stats = dict(hits=0, disk_hits=0, misses=0, not_modified=0,
+                          evicted_bytes=0, disk_evicted_bytes=0)
+        if disk_bytes:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.disk_used = sum(e.stat().st_size for e in self._disk_entries())
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key)
+
+    def _disk_entries(self):
+        """Finished disk entries; .part files are still being written."""
+        return [e for e in os.scandir(self.disk_dir) if e.is_file() and not e.name.endswith('.part')]
+
+    @property
+    def enabled(self):
+        return bool(self.memory_bytes or self.disk_bytes)
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key]
+        entry = self._disk_get(key) if self.disk_bytes else None
+        with self.lock:
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+        self._memory_put(key, entry)
+        return entry
+
+    def put(self, key, headers, body):
+        entry = (headers, body)
+        self._memory_put(key, entry)
+        if self.disk_bytes:
+            self._disk_put(key, entry)
+
+    def _memory_put(self, key, entry):
+        size = len(entry[1])
+        if size > self.memory_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry
+            self.used += size
+            while self.used > self.memory_bytes:
+                _, (_, body) = self.entries.popitem(last=False)
+                self.used -= len(body)
+                self.stats['evicted_bytes'] += len(body)
+
+    def _disk_get(self, key):
+        try:
+            with open(self._path(key), 'rb') as fh:
+                headers = json.loads(fh.readline())
+                body = fh.read()
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            return None
+        return headers, body
+
+    def _disk_put(self, key, entry):
+        head = json.dumps(entry[0]).encode() + b'\n'
+        size = len(head) + len(entry[1])
+        if size > self.disk_bytes or os.path.exists(self._path(key)):
+            return
+        tmp = self._path(key + '.part')
+        with open(tmp, 'wb') as fh:
+            fh.write(head)
+            fh.write(entry[1])  # not concatenated: bodies run to megabytes
+        os.replace(tmp, self._path(key))
+        with self.lock:
+            self.disk_used += size
+            if self.disk_used <= self.disk_bytes:
+                return
+        files = sorted(self._disk_entries(), key=lambda e: e.stat().st_mtime)
+        for e in files:
+            with self.lock:
+                if self.disk_used <= self.disk_bytes:
+                    break
+            try:
+                size = e.stat().st_size
+                os.remove(e.path)
+            except OSError:
+                continue
+            with self.lock:
+                self.disk_used -= size
+                self.stats['disk_evicted_bytes'] += size
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            hits = stats['hits'] + stats['disk_hits'] + stats['not_modified']
+            lookups = hits + stats['misses']
+            stats.update(hit_ratio=hits / lookups if lookups else 0.0,
+                         entries=len(self.entries), bytes=self.used,
+                         disk_bytes=self.disk_used if self.disk_bytes else 0)
+            return stats
+
+result_cache = ResultCache(
+    memory_bytes=int(os.environ.get('RESULT_CACHE_MB', 32)) * 1024 * 1024,
+    disk_bytes=int(os.environ.get('RESULT_CACHE_DISK_MB', 0)) * 1024 * 1024,
+)
+
+def upload_key():
+    """Hash of the upload bytes, route, form parameters and negotiated format."""
+    h = hashlib.sha256(f'{CACHE_VERSION}|{request.endpoint}|{negotiated_format()}|'.encode())
+    for name, value in sorted(request.form.items(multi=True)):
+        if name in CACHE_IGNORED_FIELDS:
+            continue
+        h.update(f'{name}={value}|'.encode())
+    for name, f in sorted(request.files.items(multi=True)):
+        h.update(f'{name}:'.encode())
+        for chunk in iter(lambda: f.stream.read(1 << 16), b''):
+            h.update(chunk)
+        f.stream.seek(0)
+    return h.hexdigest()
+
+CACHED_HEADERS = ('Content-Type', 'Content-Disposition', 'Vary')
+
+def cached(view):
+    """Serve repeat uploads from result_cache, with ETag/304 support."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with stage('hash'):
+            key = upload_key()
+        etag = f'"{key}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            with result_cache.lock:
+                result_cache.stats['not_modified'] += 1
+            return Response(status=304, headers={'ETag': etag})
+        entry = result_cache.get(key)
+        if entry is None:
+            resp = app.make_response(view(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+            if result_cache.enabled:
+                headers = {h: resp.headers[h] for h in CACHED_HEADERS if h in resp.headers}
+                resp.response = cache_as_sent(key, headers, resp.response)
+        elif wants_async():
+            # async clients expect a job, so the hit becomes one that is already done
+            _, opts = parse_options_header(entry[0].get('Content-Disposition', ''))
+            return accepted(job_queue.add_result(entry[1], entry[0]['Content-Type'], opts.get('filename')))
+        else:
+            resp = Response(entry[1], headers=entry[0])
+        resp.headers['ETag'] = etag
+        return resp
+    return wrapper
+
+def cache_as_sent(key, headers, body):
+    """Pass body through unchanged; cache it once all of it has been sent.
+
+    Chunks are only collected while they fit in the larger cache tier; a
+    bigger body is streamed without being held or cached. put() decides
+    which tiers keep the rest.
+    """
+    limit = max(result_cache.memory_bytes, result_cache.disk_bytes)
+    chunks, size = [], 0
+    try:
+        for chunk in body:
+            if chunks is not None:
+                size += len(chunk)
+                if size > limit:
+                    chunks = None  # too big to cache; stop holding it
+                else:
+                    chunks.append(chunk)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    if chunks is not None:
+        result_cache.put(key, headers, b''.join(chunks))
+
+# ---------- Batch ----------
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', 50))
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', 0)) or os.cpu_count() or 1
+
+def process_upload(data, pipeline):
+    """Run pipeline on raw upload bytes, return (encoded bytes, extension)."""
+    buf, encoder = pipeline.run(io.BytesIO(data))
+    out = buf.getvalue()
+    buffer_pool.release(buf)
+    return out, encoder.ext
+
+_batch_pool = None
+_batch_pool_lock = threading.Lock()
+
+def batch_pool():
+    # created lazily so each gunicorn worker owns its own pool; forkserver
+    # because forking a multi-threaded server process can copy a lock
+    # mid-acquire into the child
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is None:
+            _batch_pool = ProcessPoolExecutor(max_workers=BATCH_WORKERS,
+                                              mp_context=multiprocessing.get_context('forkserver'))
+        return _batch_pool
+
+def drop_batch_pool(pool):
+    """Forget pool if it is still current, so batch_pool() starts afresh.
+
+    For pools broken by a dead worker, e.g. one the OOM killer took.
+    """
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is pool:
+            _batch_pool = None
+    pool.shutdown(wait=False)
+
+def batch_submit(pool, *args):
+    """Submit process_upload(*args); returns (future, the pool it went to)."""
+    try:
+        return pool.submit(process_upload, *args), pool
+    except BrokenProcessPool:
+        drop_batch_pool(pool)
+        pool = batch_pool()
+        return pool.submit(process_upload, *args), pool
+
+class _ZipSink(io.RawIOBase):
+    """Unseekable write target that hands ZipFile output back in chunks."""
+    def __init__(self):
+        self.chunks = []
+    def writable(self):
+        return True
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+    def drain(self):
+        out = b''.join(self.chunks)
+        self.chunks.clear()
+        return out
+
+def stream_zip(futures, pool=None):
+    """Yield a ZIP archive entry by entry as futures ({future: name}) finish.
+
+    Each future is dropped once written so its result can be freed; if the
+    client goes away the ones not yet started are cancelled. If pool breaks
+    while the archive is written it is dropped, so later batches get a new one.
+    """
+    sink = _ZipSink()
+    try:
+        with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+            for fut in as_completed(futures):
+                name = futures.pop(fut)
+                try:
+                    data, ext = fut.result()
+                    zf.writestr(f'{name}.{ext}', data)
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool) and pool is not None:
+                        drop_batch_pool(pool)
+                    zf.writestr(f'{name}.error.txt', f'{type(e).__name__}: {e}')
+                yield sink.drain()
+        yield sink.drain()
+    finally:
+        for fut in futures:
+            fut.cancel()
+
+# ---------- Jobs ----------
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_QUEUE = int(os.environ.get('JOB_MAX_QUEUE', 8))  # waiting jobs before 429
+JOB_TTL = int(os.environ.get('JOB_TTL', 600))  # seconds a finished result is kept
+
+class QueueFull(Exception):
+    pass
+
+class JobQueue:
+    """In-process job runner: a thread pool plus a bounded wait queue.
+
+    Results are written under TMP_DIR and deleted, along with the job
+    record, JOB_TTL seconds after the job finishes.
+    """
+    def __init__(self, workers, max_queue, ttl, result_dir=None):
+        self.workers, self.max_queue, self.ttl = workers, max_queue, ttl
+        self.result_dir = result_dir or os.path.join(TMP_DIR, 'imagemaster-jobs')
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.inline = 0  # synchronous heavy requests in progress (see admit)
+        self.stats = dict(submitted=0, rejected=0, done=0, failed=0, expired=0)
+
+    def submit(self, pipeline, data, download_name):
+        """Queue pipeline on the upload bytes; raises QueueFull at capacity."""
+        self.sweep()
+        with self.lock:
+            if self._load() >= self.workers + self.max_queue:
+                self.stats['rejected'] += 1
+                raise QueueFull(f'job queue is full ({self.max_queue} waiting)')
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = dict(id=job_id, status='queued', progress=0.0, error=None,
+                                     created=time.time(), finished=None, path=None,
+                                     mimetype=None, download_name=download_name)
+            self.stats['submitted'] += 1
+        self.pool.submit(self._run, job_id, pipeline, data)
+        return job_id
+
+    def _load(self):
+        """Jobs queued or running plus synchronous heavy requests; lock held."""
+        return self.inline + sum(j['status'] in ('queued', 'running') for j in self.jobs.values())
+
+    @contextlib.contextmanager
+    def admit(self):
+        """Run a synchronous heavy request against the same capacity as jobs.
+
+        Raises QueueFull when workers + max_queue requests are already
+        queued or in progress, so sync clients get the 429 async ones do.
+        """
+        with self.lock:
+            if self._load() >= self.workers + self.max_queue:
+                self.stats['rejected'] += 1
+                raise QueueFull(f'server is busy ({self.workers + self.max_queue} heavy requests in progress)')
+            self.inline += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.inline -= 1
+
+    def add_result(self, body, mimetype, download_name):
+        """Record a job that is already done with body as its result."""
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.result_dir, job_id)
+        os.makedirs(self.result_dir, exist_ok=True)
+        with open(path, 'wb') as fh:
+            fh.write(body)
+        now = time.time()
+        with self.lock:
+            self.jobs[job_id] = dict(id=job_id, status='done', progress=1.0, error=None,
+                                     created=now, finished=now, path=path,
+                                     mimetype=mimetype, download_name=download_name)
+            self.stats['submitted'] += 1
+            self.stats['done'] += 1
+        return job_id
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def _run(self, job_id, pipeline, data):
+        self._update(job_id, status='running', started=time.time())
+        path = os.path.join(self.result_dir, job_id)
+        try:
+            os.makedirs(self.result_dir, exist_ok=True)
+            with open(path, 'wb') as fh:
+                _, encoder = pipeline.run(io.BytesIO(data), lambda done, total:
+                                          self._update(job_id, progress=done / total), out=fh)
+            with self.lock:
+                job = self.jobs[job_id]
+                job.update(status='done', progress=1.0, path=path, mimetype=encoder.mimetype,
+                           finished=time.time())
+                job['download_name'] = job['download_name'] or f'result.{encoder.ext}'
+            key = 'done'
+        except Exception as e:
+            self._update(job_id, status='failed', error=f'{type(e).__name__}: {e}', finished=time.time())
+            with contextlib.suppress(OSError):
+                os.remove(path)  # partial output
+            key = 'failed'
+        with self.lock:
+            self.stats[key] += 1
+
+    def get(self, job_id):
+        self.sweep()
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def sweep(self):
+        """Forget jobs (and delete results) that finished more than ttl ago."""
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            expired = [j for j in self.jobs.values() if j['finished'] and j['finished'] < cutoff]
+            for job in expired:
+                del self.jobs[job['id']]
+                self.stats['expired'] += 1
+        paths = [job['path'] for job in expired if job['path']]
+        # results orphaned by an earlier process are aged out by mtime
+        with contextlib.suppress(OSError):
+            paths += [e.path for e in os.scandir(self.result_dir)
+                      if e.name not in self.jobs and e.stat().st_mtime < cutoff]
+        for path in paths:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            for status in ('queued', 'running'):
+                stats[status] = sum(j['status'] == status for j in self.jobs.values())
+            stats['inline'] = self.inline
+            return stats
+
+job_queue = JobQueue(JOB_WORKERS, JOB_MAX_QUEUE, JOB_TTL)
+
+def wants_async():
+    """True if the client asked for a job id instead of waiting for the image."""
+    flag = request.values.get('async', '').lower() in ('1', 'true', 'yes')
+    return flag or 'respond-async' in request.headers.get('Prefer', '')
+
+def accepted(job_id):
+    """The 202 answer pointing an async client at job_id."""
+    return jsonify({'id': job_id, 'status_url': f'/jobs/{job_id}'}), 202, {'Location': f'/jobs/{job_id}'}
+
 # ---------- Updated HTML with Govt Job Tools ----------
 INDEX_HTML = r"""<!doctype html>
 <html lang="en">
@@ -158,12 +1788,19 @@ INDEX_HTML = r"""<!doctype html>
 
     <!-- Print Sheet -->
     <div id="printsheet" class="tab">
-      <h2 class="text-2xl font-bold mb-4"><i class="fas fa-print"></i> Print-Ready Photo Sheet (35×45mm)</h2>
+      <h2 class="text-2xl font-bold mb-4"><i class="fas fa-print"></i> Print-Ready Photo Sheet</h2>
       <form onsubmit="handlePrintSheet(event)">
         <input type="file" id="print-in" accept="image/*" required onchange="previewImage(this,'print-prev')" class="hidden">
         <label for="print-in" class="preview-container"><div class="text-6xl text-gray-400 mb-4"><i class="fas fa-cloud-upload-alt"></i></div>Upload Photo</label>
         <div id="print-prev" class="text-center"></div>
-        <button type="submit" class="btn-govt w-full py-4 text-xl mt-6">Generate A4 Print Sheet (6 Photos)</button>
+        <select name="layout" class="w-full p-3 border rounded-lg mt-4">
+          <option value="printsheet">6 Photos (35×45mm)</option>
+          <option value="35x45mm">Full Sheet 35×45mm (20 Photos, Cut Marks)</option>
+          <option value="2x2in">Full Sheet 2×2 inch (15 Photos, Cut Marks)</option>
+          <option value="25x35mm">Full Sheet 25×35mm (Cut Marks)</option>
+          <option value="20x25mm">Full Sheet 20×25mm Stamp Size (Cut Marks)</option>
+        </select>
+        <button type="submit" class="btn-govt w-full py-4 text-xl mt-6">Generate A4 Print Sheet</button>
       </form>
       <div id="print-result" class="mt-8"></div>
     </div>
@@ -218,130 +1855,175 @@ async function handleCompress(e){ e.preventDefault(); const f=new FormData(e.tar
 </body></html>"""
 
 # ---------- Routes ----------
+@app.errorhandler(ClientError)
+def bad_request(e):
+    return jsonify({'error': str(e)}), 400
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(e):
+    return jsonify({'error': str(e), 'reason': e.reason}), e.status
+
 @app.route('/')
 def index():
     return render_template_string(INDEX_HTML)
 
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(result_cache.report())
+
+@app.route('/batch', methods=['POST'])
+def batch():
+    """Run an op list over many uploads and stream back a ZIP.
+
+    'ops' is a JSON list applied to every file, or an object mapping upload
+    filenames to lists with an optional "*" default.
+    """
+    files = request.files.getlist('files')
+    if not files:
+        raise ClientError('no files uploaded')
+    if len(files) > BATCH_MAX_FILES:
+        raise ClientError(f'at most {BATCH_MAX_FILES} files per batch')
+    try:
+        spec = json.loads(request.form.get('ops', '[]'))
+    except json.JSONDecodeError as e:
+        raise ClientError(f'ops is not valid JSON: {e}') from None
+    # every file's ops are checked before any work is queued
+    pipelines = [Pipeline.from_spec(spec.get(f.filename, spec.get('*')) if isinstance(spec, dict) else spec)
+                 for f in files]
+    futures, pool = {}, batch_pool()
+    for i, (f, pipeline) in enumerate(zip(files, pipelines), 1):
+        stem = secure_filename(os.path.splitext(f.filename or '')[0]) or 'image'
+        try:
+            if f.filename and not allowed_filename(f.filename):
+                reject_upload(f'unsupported file type: {f.filename}', 'format', 415)
+            pil_open_validate(f.stream, pipeline.limits)
+        except UploadRejected as e:
+            # a refused file becomes its .error.txt entry, not a failed batch
+            fut = Future()
+            fut.set_exception(e)
+        else:
+            f.stream.seek(0)
+            fut, pool = batch_submit(pool, f.read(), pipeline)
+        futures[fut] = f'{i:02d}_{stem}'
+    return Response(stream_zip(futures, pool), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=batch.zip'})
+
+@app.errorhandler(QueueFull)
+def queue_full(e):
+    return jsonify({'error': str(e)}), 429, {'Retry-After': '5'}
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown or expired job'}), 404
+    body = {k: job[k] for k in ('id', 'status', 'progress', 'error')}
+    if job['status'] == 'done':
+        body['result_url'] = f'/jobs/{job_id}/result'
+    return jsonify(body)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown or expired job'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': f"job is {job['status']}"}), 409
+    return send_file(job['path'], mimetype=job['mimetype'], as_attachment=True,
+                     download_name=job['download_name'])
+
+@app.route('/jobs/stats')
+def job_stats():
+    return jsonify(job_queue.report())
+
+def run_preset(ops, download_name=None):
+    """Run ops on the 'file' upload and send the encoded result.
+
+    Streamable encoders write to the client as they go (chunked, no
+    Content-Length); the rest are sent from their pooled buffer. With
+    async requested (see wants_async) the work is queued instead and a 202
+    with the job id is returned straight away. Synchronous heavy pipelines
+    share the job queue's capacity (see JobQueue.admit) up to the encode.
+    """
+    pipe = Pipeline(ops)
+    negotiable = type(pipe.ops[-1]) is Jpeg
+    if pipe.negotiate(negotiated_format()) and download_name:
+        download_name = f'{os.path.splitext(download_name)[0]}.{pipe.ops[-1].ext}'
+    if wants_async():
+        # reject hostile uploads now rather than from inside the job
+        pil_open_validate(request.files['file'].stream, pipe.limits)
+        request.files['file'].stream.seek(0)
+        return accepted(job_queue.submit(pipe, request.files['file'].read(), download_name))
+    with job_queue.admit() if pipe.heavy else contextlib.nullcontext():
+        img = pipe.render(request.files['file'].stream)
+        encoder = pipe.encoder_for(img)
+        if STREAM_RESPONSES and encoder.streamable:
+            # decode errors have already surfaced; only the encode is streamed
+            resp = Response(stream_encode(functools.partial(pipe.encode, img), current_profile()),
+                            mimetype=encoder.mimetype)
+        else:
+            buf = pipe.encode(img)
+            resp = Response(iter_buffer(buf), mimetype=encoder.mimetype)
+            resp.content_length = buf.size
+    resp.headers.set('Content-Disposition', 'attachment',
+                     filename=download_name or f'result.{encoder.ext}')
+    if negotiable:
+        resp.vary.add('Accept')
+    return resp
+
+@app.route('/pipeline', methods=['POST'])
+@cached
+def pipeline():
+    """Run a JSON op list ('spec') on one upload: decode once, encode once."""
+    try:
+        spec = json.loads(request.form['spec'])
+    except json.JSONDecodeError as e:
+        raise ClientError(f'spec is not valid JSON: {e}') from None
+    return run_preset(Pipeline.from_spec(spec).ops)
+
 @app.route('/passport', methods=['POST'])
+@cached
 def passport():
-    f = request.files['file']
-    img = Image.open(f.stream).convert('RGB')
-    img = ImageOps.exif_transpose(img)
-    target = (413, 531)  # 35mm x 45mm at 300 DPI
-    img = ImageOps.fit(img, target, Image.LANCZOS)
-    sheet = Image.new('RGB', (2480, 3508), 'white')  # A4 at 300dpi
-    positions = [(100,100), (600,100), (1100,100), (1600,100), (100,700), (600,700)]
-    for pos in positions:
-        sheet.paste(img, pos)
-    buf = io.BytesIO()
-    sheet.save(buf, 'JPEG', quality=95)
-    buf.seek(0)
-    return send_file(buf, mimetype='image/jpeg', as_attachment=True, download_name='passport_6_copies.jpg')
+    return run_preset(passport_ops(request.form), 'passport_6_copies.jpg')
 
 @app.route('/signature', methods=['POST'])
+@cached
 def signature():
-    f = request.files['file']
-    img = Image.open(f.stream)
-    img = img.convert('RGBA')
-    img = ImageOps.invert(img.convert('L')).convert('RGBA')
-    data = img.getdata()
-    new_data = [(0,0,0,a) if r+g+b < 600 else (255,255,255,0) for r,g,b,a in data]
-    img.putdata(new_data)
-    img = img.resize((400,150), Image.LANCZOS)
-    bg_type = request.form.get('bg','white')
-    max_kb = int(request.form.get('maxkb',20))
-    if bg_type == 'white':
-        bg = Image.new('RGB', img.size, 'white')
-        bg.paste(img, mask=img)
-        img = bg
-    buf = io.BytesIO()
-    quality = 95
-    img.save(buf, 'PNG' if bg_type=='transparent' else 'JPEG', quality=quality, optimize=True)
-    while buf.tell() > max_kb*1024 and quality > 10:
-        buf = io.BytesIO()
-        quality -= 10
-        img.save(buf, 'JPEG', quality=quality, optimize=True)
-    buf.seek(0)
-    return send_file(buf, mimetype='image/png' if bg_type=='transparent' else 'image/jpeg', as_attachment=True, download_name='signature.png')
+    return run_preset(signature_ops(request.form), 'signature.png')
 
 @app.route('/scanner', methods=['POST'])
+@cached
 def scanner():
-    f = request.files['file']
-    img = Image.open(f.stream).convert('L')
-    img = ImageEnhance.Contrast(img).enhance(3.0)
-    img = img.convert('RGB')
-    buf = io.BytesIO()
-    img.save(buf, 'JPEG', quality=95)
-    buf.seek(0)
-    return send_file(buf, mimetype='image/jpeg', as_attachment=True, download_name='scanned.jpg')
+    return run_preset(scanner_ops(request.form), 'scanned.jpg')
 
 @app.route('/resizekb', methods=['POST'])
+@cached
 def resizekb():
-    f = request.files['file']
-    target_kb = int(request.form['targetkb'])
-    img = Image.open(f.stream).convert('RGB')
-    quality = 95
-    buf = io.BytesIO()
-    while True:
-        buf.seek(0)
-        buf.truncate(0)
-        img.save(buf, 'JPEG', quality=quality, optimize=True)
-        if buf.tell() <= target_kb*1024 or quality <= 10:
-            break
-        quality -= 5
-    buf.seek(0)
-    return send_file(buf, mimetype='image/jpeg', as_attachment=True, download_name='resized.jpg')
+    return run_preset(resizekb_ops(request.form), 'resized.jpg')
 
 @app.route('/border', methods=['POST'])
+@cached
 def border():
-    f = request.files['file']
-    img = Image.open(f.stream).convert('RGB')
-    img = ImageOps.expand(img, border=40, fill='white')
-    buf = io.BytesIO()
-    img.save(buf, 'JPEG', quality=95)
-    buf.seek(0)
-    return send_file(buf, mimetype='image/jpeg', as_attachment=True, download_name='photo_with_border.jpg')
+    return run_preset(border_ops(request.form), 'photo_with_border.jpg')
 
 @app.route('/printsheet', methods=['POST'])
+@cached
 def printsheet():
-    f = request.files['file']
-    img = Image.open(f.stream).convert('RGB')
-    target = (413, 531)
-    img = ImageOps.fit(img, target, Image.LANCZOS)
-    sheet = Image.new('RGB', (2480, 3508), 'white')
-    positions = [(200,150),(800,150),(1400,150),(200,800),(800,800),(1400,800)]
-    for pos in positions:
-        sheet.paste(img, pos)
-    buf = io.BytesIO()
-    sheet.save(buf, 'JPEG', quality=95)
-    buf.seek(0)
-    return send_file(buf, mimetype='image/jpeg', as_attachment=True, download_name='print_sheet.jpg')
+    return run_preset(printsheet_ops(request.form), 'print_sheet.jpg')
 
 @app.route('/bg_remove_simple', methods=['POST'])
+@cached
 def bg_remove_simple():
-    f = request.files['file']
-    img = Image.open(f.stream).convert('RGBA')
-    datas = img.getdata()
-    new_data = []
-    for item in datas:
-        if item[0] > 220 and item[1] > 220 and item[2] > 220:
-            new_data.append((255,255,255,0))
-        else:
-            new_data.append(item)
-    img.putdata(new_data)
-    buf = io.BytesIO()
-    img.save(buf, 'PNG')
-    buf.seek(0)
-    return send_file(buf, mimetype='image/png', as_attachment=True, download_name='transparent_bg.png')
+    return run_preset(bg_remove_ops(request.form), 'transparent_bg.png')
 
 @app.route('/compress', methods=['POST'])
+@cached
 def compress():
-    f = request.files['file']
-    img = Image.open(f.stream).convert('RGB')
-    buf = io.BytesIO()
-    img.save(buf, 'JPEG', quality=85, optimize=True)
-    buf.seek(0)
-    return send_file(buf, mimetype='image/jpeg', as_attachment=True, download_name='compressed.jpg')
+    return run_preset(compress_ops(request.form), 'compressed.jpg')
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,445 @@
+# bench.py – performance checks for ImageMaster Pro
+# Usage:
+#   python bench.py encode                              encode_to_size vs the old quality walk
+#   python bench.py routes --out bench_baseline.json    benchmark every route, save a baseline
+#   python bench.py routes --compare bench_baseline.json [--tolerance 0.25]
+#                                                       fail (exit 1) on regressions
+#   python bench.py load [--concurrency 8 --requests 64] server RSS under concurrent load, per mode
+import argparse, concurrent.futures, http.client, io, json, math, multiprocessing, os, platform, random, signal, socket, subprocess, sys, time
+os.environ.setdefault('RESULT_CACHE_MB', '0')  # every iteration must do the real work
+import PIL
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+import app
+
+def synthetic_photo(w, h, seed=0):
+    """Deterministic photo-like test image: colour gradients plus fine texture."""
+    rng = random.Random(seed)
+    tile = Image.frombytes('L', (256, 256), rng.randbytes(256 * 256)).filter(ImageFilter.GaussianBlur(1))
+    texture = Image.new('L', (w, h))
+    for y in range(0, h, 256):
+        for x in range(0, w, 256):
+            texture.paste(tile, (x, y))
+    grad = Image.linear_gradient('L').resize((w, h))
+    radial = Image.radial_gradient('L').resize((w, h))
+    return Image.merge('RGB', (Image.blend(grad, texture, 0.3), Image.blend(radial, texture, 0.3), texture))
+
+class EncodeCounter:
+    """Counts Image.save calls, and the megapixels they encoded, while active."""
+    def __enter__(self):
+        self.count, self.pixels, self._save = 0, 0, Image.Image.save
+        counter = self
+        def save(img, *a, **kw):
+            counter.count += 1
+            counter.pixels += img.width * img.height
+            return counter._save(img, *a, **kw)
+        Image.Image.save = save
+        return self
+    def __exit__(self, *exc):
+        Image.Image.save = self._save
+
+def legacy_resizekb(img, max_bytes):
+    """The linear quality walk /resizekb used before encode_to_size()."""
+    quality = 95
+    buf = io.BytesIO()
+    while True:
+        buf.seek(0)
+        buf.truncate(0)
+        img.save(buf, 'JPEG', quality=quality, optimize=True)
+        if buf.tell() <= max_bytes or quality <= 10:
+            break
+        quality -= 5
+    buf.seek(0)
+    return buf
+
+def bench_encode(sizes=((640, 480), (2000, 1500), (4000, 3000)), targets_kb=(20, 50, 100, 200)):
+    """Compare the old quality walk with encode_to_size().
+
+    'full' is encoded pixels divided by the image area, i.e. the cost in
+    full-resolution encode equivalents (trial encodes on reduced copies
+    count fractionally).
+    """
+    print(f"{'image':>10} {'target':>7} | {'legacy':>32} | {'encode_to_size':>32}")
+    for w, h in sizes:
+        img = synthetic_photo(w, h)
+        for kb in targets_kb:
+            row = []
+            for fn in (legacy_resizekb, app.encode_to_size):
+                with EncodeCounter() as c:
+                    t = time.perf_counter()
+                    try:
+                        out = len(fn(img, kb * 1024).getvalue())
+                    except ValueError:
+                        out = -1
+                    dt = time.perf_counter() - t
+                full = c.pixels / (w * h)
+                row.append(f'{c.count:2d} enc {full:4.1f} full {dt*1000:6.0f}ms {out/1024:6.1f}KB')
+            print(f'{w}x{h:<5} {kb:>5}KB | ' + ' | '.join(row))
+
+# ---------- Route benchmark ----------
+SIZES = {'0.3MP': (640, 480), '3MP': (2000, 1500), '12MP': (4000, 3000)}
+
+def _jpeg_exif(img):
+    exif = Image.Exif()
+    exif[0x0112] = 6  # rotate 90 CW on display
+    return 'jpg', dict(format='JPEG', quality=90, exif=exif.tobytes())
+
+def _png_alpha(img):
+    img.putalpha(Image.radial_gradient('L').resize(img.size).point(lambda v: 255 - v))
+    return 'png', dict(format='PNG')
+
+FORMATS = {
+    'jpeg-exif': _jpeg_exif,
+    'png-alpha': _png_alpha,
+    'gif': lambda img: ('gif', dict(format='GIF')),
+    'bmp': lambda img: ('bmp', dict(format='BMP')),
+    'webp': lambda img: ('webp', dict(format='WEBP', quality=85)),
+}
+
+# route -> (ops builder used for the full-resolution reference, form fields)
+ROUTES = {
+    'passport': (app.passport_ops, {}),
+    'printsheet': (app.printsheet_ops, {}),
+    'signature': (app.signature_ops, {'maxkb': '20'}),
+    'scanner': (app.scanner_ops, {}),
+    'resizekb': (app.resizekb_ops, {'targetkb': '50'}),
+    'border': (app.border_ops, {}),
+    'bg_remove_simple': (app.bg_remove_ops, {}),
+    'compress': (app.compress_ops, {}),
+}
+
+def make_upload(size, fmt):
+    """Encoded test upload as (filename, bytes)."""
+    img = synthetic_photo(*SIZES[size])
+    ext, save_kw = FORMATS[fmt](img)
+    if save_kw['format'] == 'GIF':
+        img = img.convert('P', palette=Image.ADAPTIVE)
+    buf = io.BytesIO()
+    img.save(buf, **save_kw)
+    return f'{fmt}.{ext}', buf.getvalue()
+
+def _flatten(img):
+    if img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGBA')
+        flat = Image.new('RGB', img.size, 'white')
+        flat.paste(img, mask=img)
+        return flat
+    return img.convert('RGB')
+
+def psnr(a, b):
+    hist = ImageChops.difference(a, b).histogram()
+    mse = sum((i % 256) ** 2 * n for i, n in enumerate(hist)) / (a.width * a.height * 3)
+    return 100.0 if mse == 0 else min(100.0, 10 * math.log10(255 ** 2 / mse))
+
+def ssim(a, b, window=8, side=512):
+    """Mean SSIM over non-overlapping windows of the downscaled luma."""
+    scale = min(1.0, side / max(a.size))
+    size = (max(window, int(a.width * scale)), max(window, int(a.height * scale)))
+    x = list(a.convert('L').resize(size, Image.BOX).getdata())
+    y = list(b.convert('L').resize(size, Image.BOX).getdata())
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    w, h, total, n = size[0], size[1], 0.0, 0
+    for top in range(0, h - window + 1, window):
+        for left in range(0, w - window + 1, window):
+            idx = [r * w + c for r in range(top, top + window) for c in range(left, left + window)]
+            xs, ys = [x[i] for i in idx], [y[i] for i in idx]
+            k = len(idx)
+            mx, my = sum(xs) / k, sum(ys) / k
+            vx = sum((v - mx) ** 2 for v in xs) / k
+            vy = sum((v - my) ** 2 for v in ys) / k
+            cov = sum((p - mx) * (q - my) for p, q in zip(xs, ys)) / k
+            total += ((2 * mx * my + c1) * (2 * cov + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+            n += 1
+    return total / n
+
+def reference(ops, data):
+    """Full-resolution decode of data run through the non-encoding ops.
+
+    Deliberately not Pipeline.render: no draft(), no prescale and no fused
+    luts, so shrink-on-load and resampling regressions lose PSNR/SSIM.
+    """
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    img = img.convert('RGBA' if any(op.needs_alpha for op in ops) else ops[0].decode_mode or 'RGB')
+    for op in ops:
+        if not isinstance(op, app.Encoder):
+            if op.lut is not None:
+                img = img.convert('L')
+                img = img.point(op.lut(img.histogram()))
+            else:
+                img = op.apply(img)
+    return img
+
+def quality(route, data, form, output):
+    """PSNR/SSIM of a route's output against an independent reference."""
+    ops_for, _ = ROUTES[route]
+    ops = ops_for(form)
+    ref = reference(ops, data)
+    out = Image.open(io.BytesIO(output))
+    if isinstance(ops[-1], app.Sheet):
+        x, y = app.get_layout(ops[-1].layout).positions[0]
+        out = out.crop((x, y, x + ref.width, y + ref.height))
+    ref, out = _flatten(ref), _flatten(out)
+    if out.size != ref.size:
+        out = out.resize(ref.size, Image.LANCZOS)
+    return round(psnr(ref, out), 2), round(ssim(ref, out), 4)
+
+def _status_kb(field):
+    with open('/proc/self/status') as fh:
+        for line in fh:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise OSError(field)
+
+def reset_peak_rss():
+    """Reset the kernel's RSS high-water mark; returns the current RSS.
+
+    ru_maxrss survives fork/exec, so without this a child started from a
+    parent holding 12 MP test images would report the parent's peak.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+        return _status_kb('VmRSS')
+    except OSError:
+        return app.peak_rss_bytes()
+
+def peak_rss():
+    try:
+        return _status_kb('VmHWM')
+    except OSError:
+        return app.peak_rss_bytes()
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(pct / 100 * len(values)) - 1))]
+
+def bench_route(route, filename, data, repeat):
+    """Benchmark one route on one upload; meant to run in a fresh process.
+
+    The first (cold) request gives peak memory as the rise in the process's
+    peak RSS; the following repeat requests give the latency percentiles.
+    """
+    _, form = ROUTES[route]
+    if len(data) > app.app.config['MAX_CONTENT_LENGTH']:
+        return {'status': 'skipped', 'reason': 'upload exceeds MAX_CONTENT_LENGTH'}
+    client = app.app.test_client()
+    post = lambda: client.post('/' + route, data=dict(form, file=(io.BytesIO(data), filename)))
+    before = reset_peak_rss()
+    resp = post()
+    growth = peak_rss() - before
+    if resp.status_code != 200:
+        return {'status': resp.status_code, 'error': resp.get_data(as_text=True)[:200]}
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = post().get_data()
+        times.append(time.perf_counter() - start)
+    p, s = quality(route, data, form, output)
+    return {'status': 200, 'p50_ms': round(percentile(times, 50) * 1000, 1),
+            'p95_ms': round(percentile(times, 95) * 1000, 1),
+            'peak_mem_mb': round(growth / 2 ** 20, 1), 'input_bytes': len(data),
+            'output_bytes': len(output), 'psnr': p, 'ssim': s}
+
+def bench_routes(routes, sizes, formats, repeat):
+    # one spawned interpreter per measurement so peak RSS is not masked by
+    # memory an earlier request left in the allocator
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for size in sizes:
+        for fmt in formats:
+            filename, data = make_upload(size, fmt)
+            for route in routes:
+                key = f'{route}/{fmt}/{size}'
+                with ctx.Pool(1) as pool:
+                    results[key] = r = pool.apply(bench_route, (route, filename, data, repeat))
+                if r['status'] == 200:
+                    print(f"{key:<36} p50 {r['p50_ms']:8.1f}ms  p95 {r['p95_ms']:8.1f}ms  "
+                          f"mem {r['peak_mem_mb']:6.1f}MB  out {r['output_bytes'] / 1024:8.1f}KB  "
+                          f"psnr {r['psnr']:6.2f}  ssim {r['ssim']:.4f}", flush=True)
+                else:
+                    print(f"{key:<36} {r['status']} {r.get('reason') or r.get('error')}", flush=True)
+    return {'meta': {'python': platform.python_version(), 'pillow': PIL.__version__,
+                     'machine': platform.machine(), 'cpus': os.cpu_count(), 'repeat': repeat},
+            'results': results}
+
+# ---------- Concurrent load ----------
+# app settings per load mode; 'buffered' is the pre-pool behaviour: a new
+# buffer for every response, sent only once fully encoded
+# env overrides per mode; the result cache is off unless a mode turns it on
+LOAD_MODES = {
+    'buffered': {'STREAM_RESPONSES': '0', 'BUFFER_POOL_MB': '0'},
+    'pooled': {'STREAM_RESPONSES': '0'},
+    'streamed': {},
+    'cached': {'RESULT_CACHE_MB': '32'},  # streamed, with the default cache size
+}
+# Python-heap peak (where encoded outputs live; Pillow rasters are not
+# traced): SIGUSR1 resets it, SIGTERM prints it and exits
+SERVER = """
+import os, signal, tracemalloc
+tracemalloc.start()
+import app
+from werkzeug.serving import make_server
+def stop(*_):
+    print(tracemalloc.get_traced_memory()[1], flush=True)
+    os._exit(0)
+signal.signal(signal.SIGUSR1, lambda *_: tracemalloc.reset_peak())
+signal.signal(signal.SIGTERM, stop)
+make_server('127.0.0.1', {port}, app.app, threaded=True).serve_forever()
+"""
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _multipart(filename, data, form):
+    boundary = os.urandom(16).hex()
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode()
+             for k, v in form.items()]
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def _proc_status_kb(pid, field):
+    with open(f'/proc/{pid}/status') as fh:
+        for line in fh:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise OSError(field)
+
+def bench_load(mode, routes, size, concurrency, requests):
+    """Fire requests at a real threaded server, concurrency at a time.
+
+    Runs the server in a fresh interpreter with LOAD_MODES[mode] in its
+    environment. One warm-up request per route comes first; then the
+    server's peak RSS is reset, so 'peak' is the rise caused by the load
+    and 'after' what the process still holds once it is over. Every
+    request carries a distinct form field, so none is a cache hit.
+    """
+    port = _free_port()
+    env = {**os.environ, 'RESULT_CACHE_MB': '0', **LOAD_MODES[mode]}
+    server = subprocess.Popen([sys.executable, '-c', SERVER.format(port=port)], env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        filename, data = make_upload(size, 'jpeg-exif')
+
+        def post(route, n=0):
+            body, ctype = _multipart(filename, data, dict(ROUTES[route][1], n=n))
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+            start = time.perf_counter()
+            conn.request('POST', '/' + route, body, {'Content-Type': ctype})
+            resp = conn.getresponse()
+            size = len(resp.read())
+            conn.close()
+            if resp.status != 200:
+                raise RuntimeError(f'{route}: HTTP {resp.status}')
+            return time.perf_counter() - start, size
+
+        for route in routes:
+            post(route)
+        with open(f'/proc/{server.pid}/clear_refs', 'w') as fh:
+            fh.write('5')
+        server.send_signal(signal.SIGUSR1)
+        base = _proc_status_kb(server.pid, 'VmRSS')
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(post, [routes[i % len(routes)] for i in range(requests)], range(1, requests + 1)))
+        wall = time.perf_counter() - start
+        times = [t for t, _ in results]
+        result = {'mode': mode, 'rps': round(requests / wall, 1),
+                  'p50_ms': round(percentile(times, 50) * 1000, 1),
+                  'p95_ms': round(percentile(times, 95) * 1000, 1),
+                  'base_rss_mb': round(base / 2 ** 20, 1),
+                  'peak_mb': round((_proc_status_kb(server.pid, 'VmHWM') - base) / 2 ** 20, 1),
+                  'after_mb': round((_proc_status_kb(server.pid, 'VmRSS') - base) / 2 ** 20, 1)}
+        server.terminate()
+        result['py_peak_mb'] = round(int(server.communicate(timeout=30)[0].split()[-1]) / 2 ** 20, 1)
+        return result
+    finally:
+        if server.poll() is None:
+            server.kill()
+            server.wait()
+
+def bench_loads(modes, routes, size, concurrency, requests):
+    print(f'{len(routes)} route(s) x {requests} requests, {concurrency} concurrent, {size} uploads')
+    for mode in modes:
+        r = bench_load(mode, routes, size, concurrency, requests)
+        print(f"{mode:<9} {r['rps']:6.1f} req/s  p50 {r['p50_ms']:8.1f}ms  p95 {r['p95_ms']:8.1f}ms  "
+              f"rss peak +{r['peak_mb']:6.1f}MB  after +{r['after_mb']:6.1f}MB  "
+              f"py heap peak {r['py_peak_mb']:6.1f}MB", flush=True)
+
+# metric -> (direction, absolute slack) ; a change only counts past the slack
+CHECKS = {
+    'p50_ms': ('lower', 5.0),
+    'p95_ms': ('lower', 10.0),
+    'peak_mem_mb': ('lower', 2.0),
+    'output_bytes': ('lower', 512),
+    'psnr': ('higher', 0.5),
+    'ssim': ('higher', 0.005),
+}
+
+def compare(baseline, current, tolerance):
+    """Return regression messages for current vs baseline results."""
+    problems = []
+    for key, base in baseline['results'].items():
+        cur = current['results'].get(key)
+        if cur is None or base.get('status') != 200:
+            continue
+        if cur.get('status') != 200:
+            problems.append(f"{key}: status {cur.get('status')} (baseline 200)")
+            continue
+        for metric, (better, slack) in CHECKS.items():
+            b, c = base[metric], cur[metric]
+            if better == 'lower' and c > b * (1 + tolerance) + slack:
+                problems.append(f'{key}: {metric} {c} vs baseline {b}')
+            elif better == 'higher' and c < b - slack:
+                problems.append(f'{key}: {metric} {c} vs baseline {b}')
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ImageMaster Pro benchmarks')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('encode', help='encode_to_size vs the old quality walk')
+    routes = sub.add_parser('routes', help='benchmark every image route')
+    routes.add_argument('--routes', default=','.join(ROUTES))
+    routes.add_argument('--sizes', default=','.join(SIZES))
+    routes.add_argument('--formats', default=','.join(FORMATS))
+    routes.add_argument('--repeat', type=int, default=5)
+    routes.add_argument('--out', help='write results as JSON here')
+    routes.add_argument('--compare', help='baseline JSON to check against')
+    routes.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative slowdown/growth (default 0.25)')
+    load = sub.add_parser('load', help='memory and latency under concurrent requests')
+    load.add_argument('--modes', default=','.join(LOAD_MODES))
+    load.add_argument('--routes', default='compress,scanner,border,passport')
+    load.add_argument('--size', default='3MP', choices=SIZES)
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--requests', type=int, default=64)
+    args = parser.parse_args(argv)
+    if args.command == 'load':
+        bench_loads(args.modes.split(','), args.routes.split(','), args.size, args.concurrency, args.requests)
+        return 0
+    if args.command != 'routes':
+        bench_encode()
+        return 0
+    current = bench_routes(args.routes.split(','), args.sizes.split(','), args.formats.split(','), args.repeat)
+    if args.out:
+        with open(args.out, 'w') as fh:
+            json.dump(current, fh, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fh:
+            problems = compare(json.load(fh), current, args.tolerance)
+        for p in problems:
+            print('REGRESSION', p)
+        print(f'{len(problems)} regression(s) against {args.compare}')
+        return 1 if problems else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())